@@ -19,3 +19,6 @@ print(pattern)
 
 # Generates
 # ^(?P<name>[\da-zA-Z._%+-]+)@(?P<domain>[\d\w.-]+\.[a-zA-Z]{2,})$
+
+email = compiled(pattern)
+print(email.match("john.doe@example.com").groupdict())
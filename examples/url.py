@@ -32,3 +32,6 @@ print(pat)
 
 # Generates:
 # ^(?P<protocol>[a-zA-Z]+)://(?P<domain>[a-zA-Z]+[a-zA-Z\.]+[a-zA-Z]{2,})(?::(?P<port>\d+))?(?P<path>/.*?)?(?:\?|$)(?P<parameters>.*)?$
+
+url = compiled(pat)
+print(url.match("https://example.com:8080/search?q=rebuild").groupdict())
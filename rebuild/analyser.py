@@ -1,13 +1,114 @@
 
 import re
-from ordered_set import OrderedSet
+import sys
+
+
+# Matches the start of every inner word in a camel case name
+_CAMEL_CASE_WORD = re.compile(r"(?<=[a-z])([A-Z])")
+
+
+def _never_wrapped(pattern, as_atom, in_sequence):
+    return pattern
+
+
+def _wrapped_as_atom(pattern, as_atom, in_sequence):
+    return f"(?:{pattern})" if as_atom else pattern
+
+
+def _wrapped_in_sequence(pattern, as_atom, in_sequence):
+    return f"(?:{pattern})" if in_sequence else pattern
+
+
+# Suffix of a quantifier, indexed by its is_lazy flag
+_LAZY_SUFFIX = ("", "?")
+
+
+_WRAPPERS = {
+    None: _never_wrapped,
+    "as_atom": _wrapped_as_atom,
+    "in_sequence": _wrapped_in_sequence,
+}
 
 
 class RegexNode:
+    # Nodes only store their fields (no __dict__), as large patterns create a lot of nodes.
+    # _regex_cache holds the generated pattern of the node, before it is wrapped in a non-capturing group,
+    # _optimised_cache the result of optimised() and _hash_cache the hash of the node
+    __slots__ = ("_regex_cache", "_optimised_cache", "_hash_cache")
+
+    # Public fields of the node, in the order in which they are shown by as_json
+    _fields = ()
+
+    # All fields that define the node (including private ones), compared by __eq__ and __hash__
+    _state = ()
+
+    # Name of the node and names of its fields shown by as_json, set for every subclass in __init_subclass__
+    _pretty_name = "Regex Node"
+    _pretty_field_names = ()
+
+    # When the pattern has to be wrapped in a non-capturing group:
+    # None (never), "as_atom" (when it is used as an atom) or "in_sequence" (when it is part of a sequence)
+    _wrapped_when = None
+    _wrap = staticmethod(_never_wrapped)
+
+    # Whether the node can only match in a single way (e.g. a char, char set or anchor), so that it never
+    # backtracks and can be factored out of alternations without changing which option matches first
+    _matches_one_way = False
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # E.g. "OneOrMore" --> "One Or More"
+        cls._pretty_name = _CAMEL_CASE_WORD.sub(r" \1", cls.__name__)
+        # E.g. "is_lazy" --> "Is Lazy"
+        cls._pretty_field_names = tuple(field.replace("_", " ").title() for field in cls._fields)
+        # Choose the wrapping once per class instead of checking it for every generated pattern
+        cls._wrap = staticmethod(_WRAPPERS[cls._wrapped_when])
+        cls._state = tuple(
+            name
+            for klass in reversed(cls.__mro__)
+            for name in klass.__dict__.get("__slots__", ())
+            if name not in ("_regex_cache", "_optimised_cache", "_hash_cache"))
+
+    def __new__(cls, *args, **kwargs):
+        node = super().__new__(cls)
+        node._regex_cache = None
+        node._optimised_cache = None
+        node._hash_cache = None
+        return node
+
     def optimised(self) -> "RegexNode":
+        """Returns an optimised version of this node. The result is cached, as the optimisations
+        of alternations (e.g. factoring prefixes) optimise the same subtrees again.
+        """
+        optimised = self._optimised_cache
+        if optimised is None:
+            optimised = self._optimise()
+            self._optimised_cache = optimised
+            # The optimised node does not have to be optimised again
+            if optimised._optimised_cache is None:
+                optimised._optimised_cache = optimised
+        return optimised
+
+    def _optimise(self) -> "RegexNode":
         return self
 
     def regex(self, as_atom=False, in_sequence=True) -> str:
+        """Generates the pattern of this node. The pattern is cached on the first call,
+        so changing the fields of a node afterwards is not supported.
+        """
+        # E.g. trees that are kept by the builder are converted to a pattern many times
+        body = self._regex_cache
+        if body is not None:
+            return self._wrap(body, as_atom, in_sequence)
+
+        return _generate_regex(self, as_atom, in_sequence)
+
+    def _body(self):
+        """Generates the pattern of this node, without wrapping it (see _wrapped_when).
+        Leaf nodes directly return a string. Nodes with children are generators instead,
+        which yield (child, as_atom, in_sequence) for every child pattern they need,
+        are sent the child's pattern back, and finally return their own pattern.
+        """
         return ""
 
     def __str__(self):
@@ -20,50 +121,53 @@ class RegexNode:
         if type(self) is not type(other):
             return False
 
-        own_fields = tuple((k, v) for k, v in self.__dict__.items() if not k.startswith("_"))
-        other_fields = tuple((k, v) for k, v in other.__dict__.items() if not k.startswith("_"))
+        # Nodes are hashed when they are deduplicated, so both hashes are usually known already
+        if self._hash_cache is not None and other._hash_cache is not None and self._hash_cache != other._hash_cache:
+            return False
 
-        return own_fields == other_fields
+        return all(getattr(self, name) == getattr(other, name) for name in self._state)
 
     def __hash__(self):
-        return hash(tuple(
-            (k, tuple(v) if type(v) is list else v)
-            for k, v in self.__dict__.items()
-            if not k.startswith("_")
-        ))
+        # Hashing a node hashes its whole subtree, so the hash is only computed once
+        node_hash = self._hash_cache
+        if node_hash is None:
+            values = (getattr(self, name) for name in self._state)
+            node_hash = hash(tuple(tuple(value) if type(value) is list else value for value in values))
+            self._hash_cache = node_hash
+        return node_hash
 
     def __bool__(self):
         return True
 
     def as_json(self):
-        # Automatically generate a tree structure for this object
-
-        def json_for(value):
-            """Creates a json like structure for the given object """
-            if isinstance(value, RegexNode):
-                if type(value) is EmptyNode:
-                    return None
-                return value.as_json()
-
-            if type(value) in (list, tuple):
-                return [json_for(item) for item in value]
-
-            if type(value) is str:
-                return "\"" + value + "\""
-
-            return str(value)
+        """Automatically generates a tree structure for this node.
+        The nodes are converted bottom-up with an explicit stack, so that deep trees do not hit the recursion limit.
+        """
+        # Json of every converted node, by the id of the node
+        converted = {}
+        stack = [self]
+
+        while stack:
+            node = stack[-1]
+            if id(node) in converted:
+                stack.pop()
+                continue
 
-        def prettify_varname(name):
-            return name.replace("_", " ").title()
+            # Convert the children first
+            children = [child for child in _child_nodes(node) if id(child) not in converted]
+            if children:
+                stack.extend(children)
+                continue
 
-        def prettify_classname(name):
-            return re.sub(r"(?<=[a-z])([A-Z])", r" \1", name)
+            stack.pop()
+            converted[id(node)] = node._json(converted)
 
-        # Find all properties / fields of the object
-        fields = [field for field in vars(self) if not field.startswith("_")]
+        return converted[id(self)]
 
-        # Get the name of the object's class
-        name = prettify_classname(self.__class__.__name__)
+    def _json(self, converted):
+        """Creates the json of this node, the json of its children is looked up in converted"""
+        fields = self._fields
+        name = self._pretty_name
 
         # E.g. for EmptyNode
         if len(fields) == 0:
@@ -72,7 +176,7 @@ class RegexNode:
         # If there is only one field, then ignore the name of the field
         if len(fields) == 1:
             value = getattr(self, fields[0])
-            subtree = json_for(value)
+            subtree = _json_for(value, converted)
 
             if type(subtree) is str:
                 return name + ": " + subtree
@@ -81,158 +185,400 @@ class RegexNode:
 
         subtree = {}
 
-        for field in fields:
+        for field, pretty_field in zip(fields, self._pretty_field_names):
             value = getattr(self, field)
-            value_json = json_for(value)
+            value_json = _json_for(value, converted)
 
             if value_json is None:
                 # EmptyNode
-                subtree[prettify_varname(field) + ": ---"] = None
+                subtree[pretty_field + ": ---"] = None
 
             elif type(value_json) is str:
-                subtree[prettify_varname(field) + ": " + value_json] = None
+                subtree[pretty_field + ": " + value_json] = None
             else:
-                subtree[prettify_varname(field)] = value_json
+                subtree[pretty_field] = value_json
 
         return {name: subtree}
 
     def pretty_print(self):
         tree = self.as_json()
-        _print_pretty_tree(tree)
+        # Write the whole tree at once instead of printing it line by line
+        sys.stdout.write("\n".join(_ipretty_tree(tree)) + "\n")
 
 
-def _ipretty_tree(tree, depth=0):
-    indentation = "|   " * depth
+def _json_for(value, converted):
+    """Creates a json like structure for the given field value of a node"""
+    value_type = type(value)
 
-    if type(tree) is list:
-        for item in tree:
-            yield from _ipretty_tree(item, depth)
-        return
+    if value_type is str:
+        return "\"" + value + "\""
 
-    if type(tree) is dict:
-        for name, subtree in tree.items():
-            yield indentation + name
-            if (type(subtree) is str and len(subtree) == 0) or subtree is None:
-                continue
-            yield from _ipretty_tree(subtree, depth + 1)
-        return
+    if value_type is list or value_type is tuple:
+        return [_json_for(item, converted) for item in value]
 
-    yield indentation + str(tree)
+    if isinstance(value, RegexNode):
+        if value is _EMPTY:
+            return None
+        return converted[id(value)]
 
+    return str(value)
 
-def _print_pretty_tree(tree, depth=0):
-    indentation = "|   " * depth
 
-    if type(tree) is list:
-        for item in tree:
-            _print_pretty_tree(item, depth)
-        return
+def _child_nodes(node):
+    """Yields the nodes that are stored in the fields of the given node"""
+    for field in node._fields:
+        value = getattr(node, field)
 
-    if type(tree) is dict:
-        for name, subtree in tree.items():
-            print(indentation + name)
-            if (type(subtree) is str and len(subtree) == 0) or subtree is None:
-                continue
-            _print_pretty_tree(subtree, depth+1)
-        return
+        if type(value) is list or type(value) is tuple:
+            yield from (item for item in value if isinstance(item, RegexNode))
+        elif isinstance(value, RegexNode):
+            yield value
+
+
+def _generate_regex(root, as_atom, in_sequence):
+    """Generates the pattern of a tree with an explicit stack instead of recursive regex() calls,
+    so that deeply nested trees do not hit the recursion limit.
+    Nodes are not modified once they are built, so the pattern of each node is cached.
+    """
+    stack = []
+    request = (root, as_atom, in_sequence)
+    value = None
+
+    while True:
+        if request is not None:
+            node, as_atom, in_sequence = request
+            request = None
+
+            body = node._regex_cache
+            if body is None:
+                body = node._body()
+
+                if type(body) is not str:
+                    # A node with children, which is resumed once the requested child pattern is known
+                    stack.append((node, as_atom, in_sequence, body))
+                    body = None
+                else:
+                    node._regex_cache = body
+
+            value = None if body is None else node._wrap(body, as_atom, in_sequence)
+
+        if not stack:
+            return value
 
-    print(indentation + str(tree))
+        node, as_atom, in_sequence, generator = stack[-1]
+        try:
+            request = generator.send(value)
+        except StopIteration as finished:
+            stack.pop()
+            node._regex_cache = finished.value
+            value = node._wrap(finished.value, as_atom, in_sequence)
+
+
+def _ipretty_tree(tree, depth=0):
+    # Uses an explicit stack like _generate_regex, so that deep trees do not hit the recursion limit
+    stack = [(tree, depth)]
+
+    while stack:
+        tree, depth = stack.pop()
+
+        if type(tree) is list:
+            stack.extend((item, depth) for item in reversed(tree))
+            continue
+
+        if type(tree) is dict:
+            # Pushed in reverse, so that every name is shown before its subtree
+            for name, subtree in reversed(tree.items()):
+                if not ((type(subtree) is str and len(subtree) == 0) or subtree is None):
+                    stack.append((subtree, depth + 1))
+                stack.append((name, depth))
+            continue
+
+        yield "|   " * depth + str(tree)
 
 
 class EmptyNode (RegexNode):
-    def as_json(self):
+    __slots__ = ()
+
+    # The shared instance, see _EMPTY
+    _instance = None
+
+    def __new__(cls):
+        # Every EmptyNode() is the same instance, so that checks like "node is _EMPTY"
+        # also hold for empty nodes created outside of this module
+        if cls._instance is None:
+            cls._instance = super().__new__(cls)
+        return cls._instance
+
+    def _json(self, converted):
         return "Empty"
 
     def __bool__(self):
         return False
 
 
+# Empty nodes carry no data, so one shared instance is used everywhere (see EmptyNode.__new__).
+# This allows for cheap "node is _EMPTY" checks
+_EMPTY = EmptyNode()
+
+
 class Sequence (RegexNode):
+    _fields = ("items",)
+    __slots__ = _fields
+    _wrapped_when = "as_atom"
+
     def __init__(self, items):
         self.items = items
 
-    def optimised(self) -> "RegexNode":
-        optimised = [item.optimised() for item in self.items]
-        non_empty = list(filter(None, optimised))
+    def _optimise(self) -> "RegexNode":
+        # Optimise, remove empty items and flatten nested sequences in a single pass
+        # (?:a(?:bc)d) --> (?:abcd)
+        non_empty = []
+        for item in self.items:
+            item = item.optimised()
+
+            if type(item) is Sequence:
+                non_empty.extend(item.items)
+            elif item is not _EMPTY:
+                non_empty.append(item)
 
         if len(non_empty) == 0:
-            return EmptyNode()
+            return _EMPTY
 
         if len(non_empty) == 1:
             return non_empty[0]
 
         return Sequence(non_empty)
 
-    def regex(self, as_atom=False, in_sequence=True) -> str:
-        pattern = "".join(item.regex() for item in self.items)
-        if as_atom:
-            return "(?:" + pattern + ")"
-        return pattern
+    def _body(self):
+        parts = []
+        for item in self.items:
+            # Literal characters (most items of a sequence) are added directly,
+            # without a round trip through _generate_regex
+            if type(item) is SingleChar:
+                parts.append(item.char)
+            else:
+                parts.append((yield item, False, True))
 
+        pattern = "".join(parts)
+        return pattern
 
-# TODO: Factor out common subexpressions in sequences
-# (?:aa|ab|ac) --> a(?:a|b|c) --> a[abc]
-# Or perhaps (?:a(?:a|b|c)) --> (?:a[abc]) --> a[abc]
-# This is useful for cases like: (?:grey|gray) --> gr[ea]y
 
 # TODO: Remove redundant items after empties
 # (?:a||b|c) --> (?:a|)
 class Alternation (RegexNode):
+    _fields = ("options",)
+    __slots__ = _fields
+    _wrapped_when = "in_sequence"
+
     def __init__(self, options):
         self.options = options
 
-    def _remove_duplicates(self, options):
-        return list(OrderedSet(options))
+    def _optimised_unique_options(self):
+        """Optimise the options, flatten nested alternations and remove duplicates in a single pass
+        (?:a|(?:b|c)) --> (?:a|b|c)
+        (?:a|b|a) --> (?:a|b)
+        """
+        # Dicts keep the insertion order, so the first occurrence of every option is kept
+        unique = {}
+        for item in self.options:
+            item = item.optimised()
+
+            if type(item) is Alternation:
+                for option in item.options:
+                    unique[option] = None
+            else:
+                unique[item] = None
 
-    def _flatten_alternations(self, options):
-        """Flatten nested alternations (?:a|(?:b|c)) --> (?:a|b|c)"""
+        return list(unique)
 
+    def _join_adjacent_chars(self, options):
+        """Merge items together, that come directly after one another
+        (?:a|b|c|hello) --> (?:[abc]|hello)
+        (?:[0-9]|[a-z]|hello) --> (?:[0-9a-z]|hello)
+        """
         simplified = []
+        # Adjacent items that could be merged into a char set
+        chars = []
+
         for item in options:
-            if type(item) is Alternation:
-                simplified.extend(item.options)
+            if type(item) is CharSet or (type(item) is SingleChar and item.fits_in_char_set()):
+                chars.append(item)
                 continue
 
+            if chars:
+                self._merge_chars(chars, simplified)
+                chars = []
+
             simplified.append(item)
 
+        if chars:
+            self._merge_chars(chars, simplified)
+
         return simplified
 
-    def _join_adjacent_chars(self, options):
-        """Merge items together, that come directly after one another
-        (?:a|b|c|hello) --> (?:[abc]|hello)
-        (?:[0-9]|[a-z]|hello) --> (?:[0-9a-z]|hello)
+    def _group_chars(self, options):
+        """Move chars next to the previous char set, if the options in between can never match
+        at the same position, so that they can be merged
+        (?:a|foo|b) --> (?:a|b|foo) --> (?:[ab]|foo)
+        As only options that cannot both match are swapped, the matching order stays the same.
         """
-        current_char_set = CharSet([])
+        grouped = []
 
-        simplified = []
+        for item in options:
+            if _is_mergeable_char(item) and grouped:
+                chars = _first_chars(item)
+
+                position = len(grouped)
+                while chars is not None and position > 0 and not _is_mergeable_char(grouped[position - 1]):
+                    other_chars = _first_chars(grouped[position - 1])
+                    if other_chars is None or not chars.isdisjoint(other_chars):
+                        break
+                    position -= 1
+
+                if position < len(grouped) and position > 0 and _is_mergeable_char(grouped[position - 1]):
+                    grouped.insert(position, item)
+                    continue
+
+            grouped.append(item)
+
+        return grouped
+
+    def _group_common_prefixes(self, options):
+        """Move options next to the previous option with the same first atom, if the options in between
+        can never match at the same position, so that their common prefix can be factored out
+        (?:foo|bar|for) --> (?:foo|for|bar) --> (?:fo[or]|bar)
+        """
+        grouped = []
+        first_atoms = []
 
         for item in options:
-            succeeded = current_char_set.merge_with(item)
+            atom, _ = _split_first_atom(item)
+            position = len(grouped)
 
-            if succeeded:
-                continue
+            if atom is not None and position > 0 and first_atoms[-1] != atom:
+                chars = _first_chars(item)
+
+                while chars is not None and position > 0 and first_atoms[position - 1] != atom:
+                    other_chars = _first_chars(grouped[position - 1])
+                    if other_chars is None or not chars.isdisjoint(other_chars):
+                        break
+                    position -= 1
+
+                # No option with the same first atom was reached
+                if position == 0 or first_atoms[position - 1] != atom:
+                    position = len(grouped)
+
+            grouped.insert(position, item)
+            first_atoms.insert(position, atom)
 
-            if len(current_char_set.options) > 0:
+        return grouped
+
+    def _merge_chars(self, chars, simplified):
+        """Merge the given adjacent chars and char sets into as few char sets as possible"""
+        if len(chars) == 1:
+            simplified.append(chars[0])
+            return
+
+        current_char_set = None
+
+        for item in chars:
+            if current_char_set is not None:
+                if current_char_set.merge_with(item):
+                    continue
                 simplified.append(current_char_set.optimised())
-                current_char_set = CharSet([])
 
-            succeeded = current_char_set.merge_with(item)
-            if not succeeded:
-                simplified.append(item)
+            # Every run of mergeable items starts a new char set, which can then be extended in place
+            if type(item) is CharSet:
+                current_char_set = CharSet(list(item.options), item.is_inverted)
+            else:
+                current_char_set = CharSet([item])
 
-        if len(current_char_set.options) > 0:
-            simplified.append(current_char_set.optimised())
+        simplified.append(current_char_set.optimised())
 
-        return simplified
+    def _factor_common_prefixes(self, options):
+        """Factor out the first atom of adjacent options, if they share it
+        (?:abc|abd|xyz) --> (?:a(?:bc|bd)|xyz) --> (?:ab(?:c|d)|xyz)
+        Only atoms that can match in exactly one way are factored out, and options are never
+        reordered, so that the matching order of the alternation stays the same.
+        """
+        return self._factor_common_atoms(options, _split_first_atom, lambda atom, rest: [atom, rest])
 
-    def optimised(self) -> "RegexNode":
-        optimised = [item.optimised() for item in self.options]
+    def _factor_common_suffixes(self, options):
+        """Factor out the last atom of adjacent options, if they share it
+        (?:ey|ay) --> (?:e|a)y --> [ea]y
+        """
+        return self._factor_common_atoms(options, _split_last_atom, lambda atom, rest: [rest, atom])
 
-        optimised = self._flatten_alternations(optimised)
-        optimised = self._remove_duplicates(optimised)
-        optimised = self._join_adjacent_chars(optimised)
+    def _factor_common_atoms(self, options, split_atom, join):
+        simplified = []
 
-        optimised = [item.optimised() for item in optimised]
+        # Split every option only once, as the split is needed both for comparing and for factoring
+        splits = [split_atom(option) for option in options]
+
+        start = 0
+        while start < len(options):
+            atom = splits[start][0]
+
+            end = start + 1
+            if atom is not None:
+                while end < len(options) and splits[end][0] == atom:
+                    end += 1
+
+            if end - start < 2:
+                simplified.append(options[start])
+                start += 1
+                continue
+
+            rests = [rest for _, rest in splits[start:end]]
+            simplified.append(Sequence(join(atom, Alternation(rests))).optimised())
+            start = end
+
+        return simplified
+
+    def _replace_empty_option(self, options):
+        """An empty option at either end of an alternation is equivalent to an optional group
+        (?:a|b|) --> (?:a|b)?
+        (?:|a|b) --> (?:a|b)??
+        """
+        if len(options) < 2:
+            return None
+
+        if options[-1] is _EMPTY:
+            rest = options[:-1]
+            is_lazy = False
+        elif options[0] is _EMPTY:
+            rest = options[1:]
+            is_lazy = True
+        else:
+            return None
+
+        if any(option is _EMPTY for option in rest):
+            return None
+
+        pattern = rest[0] if len(rest) == 1 else Alternation(rest)
+        return Optional(pattern, is_lazy)
+
+    def _optimise(self) -> "RegexNode":
+        if len(self.options) == 1:
+            return self.options[0].optimised()
+
+        optimised = self._optimised_unique_options()
+
+        # Factoring and merging can enable each other, so they are repeated until the options stop changing
+        # (?:ab|b|ac|c) --> (?:a[bc]|[bc]) --> a?[bc]
+        while True:
+            option_count = len(optimised)
+
+            optimised = self._group_common_prefixes(optimised)
+            optimised = self._factor_common_prefixes(optimised)
+            optimised = self._factor_common_suffixes(optimised)
+            optimised = self._group_chars(optimised)
+            optimised = self._join_adjacent_chars(optimised)
+            # Factoring and merging can turn different options into equal ones
+            optimised = list(dict.fromkeys(optimised))
+
+            if len(optimised) == option_count:
+                break
 
         # Alternations are not required for single items
         # (?:[a-z]) --> [a-z]
@@ -240,280 +586,642 @@ class Alternation (RegexNode):
         if len(optimised) == 1:
             return optimised[0]
 
+        optional = self._replace_empty_option(optimised)
+        if optional is not None:
+            return optional
+
         return Alternation(optimised)
 
-    def regex(self, as_atom=False, in_sequence=True) -> str:
-        pattern = "|".join(option.regex() for option in self.options)
+    def _body(self):
+        parts = []
+        for option in self.options:
+            parts.append((yield option, False, True))
 
-        if not in_sequence:
-            return pattern
-        return f"(?:{pattern})"
+        pattern = "|".join(parts)
+        return pattern
+
+
+def _is_mergeable_char(node):
+    """Whether the node can be merged into a (not inverted) char set"""
+    if type(node) is CharSet:
+        return not node.is_inverted
+    return type(node) is SingleChar and node.fits_in_char_set()
+
+
+def _split_first_atom(node):
+    """Splits off the first atom of a node, if it always matches in the same way
+    (e.g. a single character or a char set, but not a quantifier or a group).
+    Returns (atom, rest) or (None, None)
+    """
+    return _split_atom(node, 0)
+
+
+def _split_last_atom(node):
+    """Same as _split_first_atom, but splits off the last atom instead"""
+    return _split_atom(node, -1)
+
+
+def _split_atom(node, index):
+    if type(node) is Sequence:
+        atom = node.items[index]
+        if atom._matches_one_way:
+            rest = node.items[1:] if index == 0 else node.items[:-1]
+            return atom, rest[0] if len(rest) == 1 else Sequence(rest)
+        return None, None
+
+    if node._matches_one_way:
+        return node, _EMPTY
+
+    return None, None
+
+
+def _literal_char(char):
+    """Returns the character matched by a single char pattern (e.g. "a", "\\." or "\\x41"),
+    or None if it is not a literal
+    """
+    if len(char) == 1:
+        return None if char == "." else char
+
+    if char[0] != "\\":
+        return None
+
+    if len(char) == 2:
+        # Escaped letters and digits are classes or special characters (e.g. \\d, \\n)
+        return None if char[1].isalnum() else char[1]
+
+    if char[1] in "xu":
+        return chr(int(char[2:], 16))
+
+    return None
+
+
+def _case_variants(char):
+    """Returns every character that char could match, regardless of the flags the pattern is compiled with"""
+    # Non-ASCII characters have special case folding rules and whitespace
+    # and comments are ignored in verbose mode
+    if char is None or not char.isascii() or char.isspace() or char == "#":
+        return None
+
+    return {char.lower(), char.upper()}
+
+
+def _case_folded(chars):
+    """Returns every character that the given characters could match, regardless of the flags the pattern is
+    compiled with, or None if this is unknown
+    """
+    if chars is None:
+        return None
+
+    folded = set()
+    for char in chars:
+        variants = _case_variants(char)
+        if variants is None:
+            return None
+        folded |= variants
+    return folded
+
+
+def _matched_chars(node):
+    """Returns the exact set of characters matched by a single char or a range, or None if it is unknown"""
+    if type(node) is SingleChar:
+        char = _literal_char(node.char)
+        return None if char is None else {char}
+
+    if type(node) is Range:
+        from_char = _literal_char(node.from_char)
+        to_char = _literal_char(node.to_char)
+        if from_char is None or to_char is None or not (from_char + to_char).isascii():
+            return None
+        return {chr(code) for code in range(ord(from_char), ord(to_char) + 1)}
+
+    return None
+
+
+def _chars_of_options(options):
+    """Returns the exact set of characters matched by the options of a char set, or None if it is unknown"""
+    chars = set()
+    for option in options:
+        option_chars = _matched_chars(option)
+        if option_chars is None:
+            return None
+        chars |= option_chars
+    return chars
+
+
+def _first_chars(node):
+    """Returns the set of characters that a match of the node can start with,
+    or None if this is unknown or if the node can match an empty string
+    """
+    node_type = type(node)
+
+    if node_type in (SingleChar, Range):
+        return _case_folded(_matched_chars(node))
+
+    if node_type is CharSet:
+        if node.is_inverted:
+            return None
+        return _first_chars_of_all(node.options)
+
+    if node_type is Sequence:
+        return _first_chars(node.items[0])
+
+    if node_type is Alternation:
+        return _first_chars_of_all(node.options)
+
+    if node_type in (OneOrMore, CapturingGroup, NamedCapturingGroup):
+        return _first_chars(node.pattern)
+
+    if node_type in (RepeatExactlyN, RepeatAtLeastN, RepeatBetweenNM) and node.n > 0:
+        return _first_chars(node.pattern)
+
+    return None
+
+
+def _first_chars_of_all(nodes):
+    """Returns the union of the first characters of all nodes, or None if it is unknown for any of them"""
+    chars = set()
+    for node in nodes:
+        node_chars = _first_chars(node)
+        if node_chars is None:
+            return None
+        chars |= node_chars
+    return chars
+
+
+# Chars that mean something else inside of a char set
+_NOT_IN_CHAR_SET = frozenset((".", "\\A", "\\b", "\\B", "\\Z"))
+
+# Chars that have to be escaped outside of a char set
+_SPECIAL_OUTSIDE_CHAR_SET = frozenset(".^$*+?{}[]()|") | {"\\b"}
 
 
 class SingleChar (RegexNode):
+    _fields = ("char",)
+    __slots__ = _fields
+    _matches_one_way = True
+
+    # Shared instances of ASCII characters and escapes, see SingleChar.get()
+    _interned = {}
+
     def __init__(self, char):
         self.char = char
 
-    def regex(self, as_atom=False, in_sequence=True) -> str:
+    @classmethod
+    def get(cls, char):
+        """Returns a shared node for ASCII characters (e.g. "a" or "\\d"), as nodes are never modified"""
+        node = cls._interned.get(char)
+        if node is not None:
+            return node
+
+        node_class = ZeroWidthEscape if char in _ZERO_WIDTH_ESCAPES else cls
+        # Parser tokens are converted, so that nodes do not keep them (and their positions) alive
+        node = node_class(str(char))
+        if char.isascii() and (len(char) == 1 or (len(char) == 2 and char[0] == "\\")):
+            cls._interned[node.char] = node
+        return node
+
+    def fits_in_char_set(self):
+        """Whether the char means the same inside of a char set: [.] only matches a dot and [\\b] a backspace"""
+        return self.char not in _NOT_IN_CHAR_SET
+
+    def fits_outside_char_set(self):
+        """Whether the char means the same outside of a char set: [?] cannot be simplified to ?"""
+        return self.char not in _SPECIAL_OUTSIDE_CHAR_SET
+
+    def _body(self):
         return self.char
 
 
+# Escapes that match a position instead of a character. Like anchors, they cannot be quantified directly
+_ZERO_WIDTH_ESCAPES = frozenset(("\\A", "\\b", "\\B", "\\Z"))
+
+
+class ZeroWidthEscape (SingleChar):
+    """A zero-width escape like \\b. Factoring alternations can make it optional (a\\b|a --> a(?:\\b)?),
+    but \\b? is invalid, so it is wrapped when used as an atom (same as anchors)
+    """
+    __slots__ = ()
+
+    _wrapped_when = "as_atom"
+
+
 class OneOrMore (RegexNode):
+    _fields = ("is_lazy", "pattern")
+    __slots__ = _fields
+    _wrapped_when = "as_atom"
+    # Quantifier, indexed by is_lazy
+    _suffixes = ("+", "+?")
+
     def __init__(self, pattern, is_lazy=False):
         self.is_lazy = is_lazy
         self.pattern = pattern
 
-    def optimised(self) -> "RegexNode":
+    def _optimise(self) -> "RegexNode":
         optimised = self.pattern.optimised()
 
-        if type(optimised) is EmptyNode:
-            return EmptyNode()
+        if optimised is _EMPTY:
+            return _EMPTY
 
-        if type(optimised) in (ZeroOrMore, Optional, OneOrMore):
-            return OneOrMore(optimised.pattern, self.is_lazy)
+        # Nested quantifiers can only be merged if both are greedy, e.g. (?:a??)+ prefers to match nothing
+        if type(optimised) in (ZeroOrMore, Optional, OneOrMore) and not (self.is_lazy or optimised.is_lazy):
+            if type(optimised) is OneOrMore:
+                return OneOrMore(optimised.pattern)
+
+            # (?:a?)+ or (?:a|)+ also match the empty string
+            return ZeroOrMore(optimised.pattern)
 
         return OneOrMore(optimised, self.is_lazy)
 
-    def regex(self, as_atom=False, in_sequence=True) -> str:
-        if type(self.pattern) is EmptyNode:
+    def _body(self):
+        if self.pattern is _EMPTY:
             return ""
 
-        regex = self.pattern.regex(as_atom=True) + "+"
-
-        if self.is_lazy:
-            regex += "?"
-
-        if as_atom:
-            return f"(?:{regex})"
-
-        return regex
+        regex = yield self.pattern, True, True
+        return regex + self._suffixes[self.is_lazy]
 
 
 class ZeroOrMore (RegexNode):
+    _fields = ("is_lazy", "pattern")
+    __slots__ = _fields
+    _wrapped_when = "as_atom"
+    # Quantifier, indexed by is_lazy
+    _suffixes = ("*", "*?")
+
     def __init__(self, pattern, is_lazy=False):
         self.is_lazy = is_lazy
         self.pattern = pattern
 
-    def optimised(self) -> "RegexNode":
+    def _optimise(self) -> "RegexNode":
         optimised = self.pattern.optimised()
 
-        if type(optimised) is EmptyNode:
-            return EmptyNode()
+        if optimised is _EMPTY:
+            return _EMPTY
 
-        if type(optimised) in (ZeroOrMore, Optional, OneOrMore):
-            return ZeroOrMore(optimised.pattern, self.is_lazy)
+        if type(optimised) in (ZeroOrMore, Optional, OneOrMore) and not (self.is_lazy or optimised.is_lazy):
+            return ZeroOrMore(optimised.pattern)
 
         return ZeroOrMore(optimised, self.is_lazy)
 
-    def regex(self, as_atom=False, in_sequence=True) -> str:
-        if type(self.pattern) is EmptyNode:
+    def _body(self):
+        if self.pattern is _EMPTY:
             return ""
 
-        regex = self.pattern.regex(as_atom=True) + "*"
-
-        if self.is_lazy:
-            regex += "?"
-
-        if as_atom:
-            return f"(?:{regex})"
-
-        return regex
+        regex = yield self.pattern, True, True
+        return regex + self._suffixes[self.is_lazy]
 
 
 class Optional (RegexNode):
+    _fields = ("is_lazy", "pattern")
+    __slots__ = _fields
+    _wrapped_when = "as_atom"
+    # Quantifier, indexed by is_lazy
+    _suffixes = ("?", "??")
+
     def __init__(self, pattern, is_lazy=False):
         self.is_lazy = is_lazy
         self.pattern = pattern
 
-    def optimised(self) -> "RegexNode":
+    def _optimise(self) -> "RegexNode":
         optimised = self.pattern.optimised()
 
-        if type(optimised) is EmptyNode:
-            return EmptyNode()
+        if optimised is _EMPTY:
+            return _EMPTY
 
         return Optional(optimised, self.is_lazy)
 
-    def regex(self, as_atom=False, in_sequence=True) -> str:
-        if type(self.pattern) is EmptyNode:
+    def _body(self):
+        if self.pattern is _EMPTY:
             return ""
 
-        regex = self.pattern.regex(as_atom=True) + "?"
-
-        if self.is_lazy:
-            regex += "?"
-
-        if as_atom:
-            return f"(?:{regex})"
-
-        return regex
+        regex = yield self.pattern, True, True
+        return regex + self._suffixes[self.is_lazy]
 
 
 class CapturingGroup (RegexNode):
+    _fields = ("pattern",)
+    __slots__ = _fields
+
     def __init__(self, pattern):
         self.pattern = pattern
 
-    def optimised(self) -> "RegexNode":
+    def _optimise(self) -> "RegexNode":
         return CapturingGroup(self.pattern.optimised())
 
-    def regex(self, as_atom=False, in_sequence=True) -> str:
-        return f"({self.pattern.regex(in_sequence=False)})"
+    def _body(self):
+        pattern = yield self.pattern, False, False
+        return f"({pattern})"
 
 
 class NonCapturingGroup (RegexNode):
+    _fields = ("pattern",)
+    __slots__ = _fields
+
     def __init__(self, pattern):
         self.pattern = pattern
 
-    def optimised(self) -> "RegexNode":
+    def _optimise(self) -> "RegexNode":
         return self.pattern.optimised()
 
-    def regex(self, as_atom=False, in_sequence=True) -> str:
-        return f"(?:{self.pattern.regex(in_sequence=False)})"
+    def _body(self):
+        pattern = yield self.pattern, False, False
+        return f"(?:{pattern})"
 
 
 class NamedCapturingGroup (RegexNode):
+    _fields = ("name", "pattern")
+    __slots__ = _fields
+
     def __init__(self, name, pattern):
         self.name = name
         self.pattern = pattern
 
-    def optimised(self) -> "RegexNode":
+    def _optimise(self) -> "RegexNode":
         return NamedCapturingGroup(self.name, self.pattern.optimised())
 
-    def regex(self, as_atom=False, in_sequence=True) -> str:
-        return f"(?P<{self.name}>{self.pattern.regex(in_sequence=False)})"
+    def _body(self):
+        pattern = yield self.pattern, False, False
+        return f"(?P<{self.name}>{pattern})"
+
+
+class NumberedBackreference (RegexNode):
+    _fields = ("number",)
+    __slots__ = _fields
+
+    def __init__(self, number):
+        self.number = number
+
+    def _body(self):
+        return f"\\{self.number}"
 
 
 class ModeGroup (RegexNode):
+    _fields = ("modifiers", "pattern")
+    __slots__ = _fields
+
     def __init__(self, modifiers, pattern):
         self.modifiers = modifiers
         self.pattern = pattern
 
-    def optimised(self) -> "RegexNode":
-        if type(self.pattern) is EmptyNode:
-            return EmptyNode()
+    def _optimise(self) -> "RegexNode":
+        if self.pattern is _EMPTY:
+            return _EMPTY
 
         if len(self.modifiers) == 0:
             return self.pattern.optimised()
 
         return ModeGroup(self.modifiers, self.pattern.optimised())
 
-    def regex(self, as_atom=False, in_sequence=True) -> str:
-        if type(self.pattern) is EmptyNode:
+    def _body(self):
+        if self.pattern is _EMPTY:
             return ""
 
         if len(self.modifiers) == 0:
-            return self.pattern.regex(as_atom=as_atom)
+            pattern = yield self.pattern, False, False
+            return f"(?:{pattern})"
+
+        pattern = yield self.pattern, False, False
+        return f"(?{self.modifiers}:{pattern})"
+
+
+class AtomicGroup (RegexNode):
+    _fields = ("pattern",)
+    __slots__ = _fields
+
+    def __init__(self, pattern):
+        self.pattern = pattern
+
+    def _optimise(self) -> "RegexNode":
+        optimised = self.pattern.optimised()
+
+        # Patterns that can only match in a single way never backtrack anyway
+        # (?>a) --> a
+        if optimised is _EMPTY or optimised._matches_one_way:
+            return optimised
+
+        return AtomicGroup(optimised)
 
-        return f"(?{self.modifiers}:{self.pattern.regex(in_sequence=False)})"
+    def _body(self):
+        pattern = yield self.pattern, False, False
+        return f"(?>{pattern})"
 
 
 class IfElseGroup (RegexNode):
+    _fields = ("name", "then", "elsewise")
+    __slots__ = _fields
+
     def __init__(self, name, then, elsewise):
         self.name = name
         self.then = then
         self.elsewise = elsewise
 
-    def optimised(self) -> "RegexNode":
-        if type(self.then) is EmptyNode and type(self.elsewise) is EmptyNode:
-            return EmptyNode()
+    def _optimise(self) -> "RegexNode":
+        if self.then is _EMPTY and self.elsewise is _EMPTY:
+            return _EMPTY
         return IfElseGroup(self.name, self.then.optimised(), self.elsewise.optimised())
 
-    def regex(self, as_atom=False, in_sequence=True) -> str:
-        return f"(?({self.name}){self.then.regex()}|{self.elsewise.regex()})"
+    def _body(self):
+        then = yield self.then, False, True
+        elsewise = yield self.elsewise, False, True
+        return f"(?({self.name}){then}|{elsewise})"
 
 
 class Lookaround (RegexNode):
+    _fields = ("pattern",)
+    __slots__ = ("pattern", "_symbol")
+
     def __init__(self, pattern, symbol="="):
         self.pattern = pattern
         self._symbol = symbol
 
-    def optimised(self) -> "RegexNode":
-        if type(self.pattern) is EmptyNode:
-            return EmptyNode()
+    def _optimise(self) -> "RegexNode":
+        if self.pattern is _EMPTY:
+            return _EMPTY
         return Lookaround(self.pattern.optimised(), self._symbol)
 
-    def regex(self, as_atom=False, in_sequence=True) -> str:
-        return f"(?{self._symbol}{self.pattern.regex(in_sequence=False)})"
+    def _body(self):
+        pattern = yield self.pattern, False, False
+        return f"(?{self._symbol}{pattern})"
 
 
 class Lookahead (Lookaround):
+    __slots__ = ()
+
     def __init__(self, pattern):
         super().__init__(pattern, "=")
 
 
 class NegativeLookahead (Lookaround):
+    __slots__ = ()
+
     def __init__(self, pattern):
         super().__init__(pattern, "!")
 
 
 class Lookbehind (Lookaround):
+    __slots__ = ()
+
     def __init__(self, pattern):
         super().__init__(pattern, "<=")
 
 
 class NegativeLookbehind (Lookaround):
+    __slots__ = ()
+
     def __init__(self, pattern):
         super().__init__(pattern, "<!")
 
 
 class AnchorStart (RegexNode):
-    def regex(self, as_atom=False, in_sequence=True) -> str:
+    __slots__ = ()
+    _matches_one_way = True
+
+    # Anchors cannot be quantified directly (^? is invalid), but (?:^)? is
+    _wrapped_when = "as_atom"
+
+    def _body(self):
         return "^"
 
 
 class AnchorEnd (RegexNode):
-    def regex(self, as_atom=False, in_sequence=True) -> str:
+    __slots__ = ()
+    _matches_one_way = True
+
+    _wrapped_when = "as_atom"
+
+    def _body(self):
         return "$"
 
 
+_DASH = SingleChar.get("-")
+_ESCAPED_DASH = SingleChar.get("\\-")
+
+
 class CharSet (RegexNode):
+    _fields = ("is_inverted", "options")
+    __slots__ = _fields
+    _matches_one_way = True
+
     def __init__(self, options, is_inverted=False):
         self.is_inverted = is_inverted
         self.options = options
 
-    def optimised(self) -> "RegexNode":
+    def _optimise(self) -> "RegexNode":
         if len(self.options) == 0:
-            return EmptyNode()
+            return _EMPTY
 
-        unique_options = list(OrderedSet(self.options))
+        # [a-a] --> [a]
+        options = [option.optimised() if type(option) is Range else option for option in self.options]
 
-        if len(unique_options) == 1 and type(unique_options[0]) is SingleChar:
-            return unique_options[0]
+        # A single option cannot have any duplicates
+        if len(options) == 1:
+            unique_options = options
+        else:
+            # Dicts keep the insertion order, so the first occurrence of every option is kept
+            unique_options = list(dict.fromkeys(options))
+
+        # [a] --> a
+        if len(unique_options) == 1 and not self.is_inverted:
+            option = unique_options[0]
+            if type(option) is SingleChar and option.fits_outside_char_set():
+                return option
 
         # TODO: Remove single chars that are already included in a range
 
         return CharSet(unique_options, self.is_inverted)
 
     def merge_with(self, node):
+        self._regex_cache = None
+        self._optimised_cache = None
+        self._hash_cache = None
+
         if type(node) is CharSet:
             if len(self.options) == 0:
                 self.is_inverted = node.is_inverted
+                self.options = list(node.options)
+                return True
 
             if self.is_inverted and node.is_inverted:
-                self_unique = OrderedSet(self.options)
-                other_unique = OrderedSet(node.options)
-
-                # [^abc] + [^bc] --> [^a]
-                merged_options = self_unique.symmetric_difference(other_unique)
-                self.options = list(merged_options)
-                return True
+                return self._intersect_with(node)
 
             if not self.is_inverted and not node.is_inverted:
-                self.options.extend(node.options)
+                self._add_options(node.options)
                 return True
 
             return False
 
-        if not self.is_inverted and type(node) is SingleChar:
-            self.options.append(node)
+        if not self.is_inverted and type(node) is SingleChar and node.fits_in_char_set():
+            self._add_options([node])
             return True
 
         return False
 
-    def regex(self, as_atom=False, in_sequence=True) -> str:
-        pattern = ''.join([option.regex() for option in self.options])
+    def _add_options(self, options):
+        """Appends the options of a merged node. A dash that ends up between two chars
+        would turn them into a range, so it is escaped: a|-|b --> [a\\-b]
+        Dashes inside of the merged nodes are kept as they are, as they can be part of a range.
+        """
+        end = len(self.options)
+        self.options.extend(options)
+
+        for i in (end - 1, end):
+            if 0 < i < len(self.options) - 1 and self.options[i] == _DASH:
+                self.options[i] = _ESCAPED_DASH
+
+    def _intersect_with(self, node):
+        """Merges two inverted char sets, which only exclude the characters that both of them exclude
+        [^abc] + [^bcd] --> [^bc]
+        Only succeeds if the excluded characters are known exactly and are the same for every flag
+        (e.g. [^a] + [^A] cannot be merged, as both exclude a and A with IGNORECASE)
+        """
+        own_chars = _chars_of_options(self.options)
+        other_chars = _chars_of_options(node.options)
+        if own_chars is None or other_chars is None:
+            return False
+
+        common_chars = own_chars & other_chars
+
+        folded_own = _case_folded(own_chars)
+        folded_other = _case_folded(other_chars)
+        if folded_own is None or folded_other is None or _case_folded(common_chars) != folded_own & folded_other:
+            return False
+
+        # The common characters have to be made up of whole options of either char set
+        # [^a-c] + [^b] --> [^b]
+        for options, other in ((self.options, other_chars), (node.options, own_chars)):
+            kept_options = [option for option in options if _matched_chars(option) <= other]
+
+            # [^] is not a valid char set
+            if len(kept_options) > 0 and _chars_of_options(kept_options) == common_chars:
+                self.options = kept_options
+                return True
+
+        return False
+
+    def _body(self):
+        parts = []
+        for option in self.options:
+            # Same as in Sequence._body, single chars are added directly
+            if type(option) is SingleChar:
+                parts.append(option.char)
+            else:
+                parts.append((yield option, False, True))
+
+        # Merged chars and ranges can end up after the first position, where ] would close the set: [a\]]
+        for i in range(1, len(parts)):
+            if parts[i].startswith("]"):
+                parts[i] = "\\" + parts[i]
+
+        if parts:
+            # A leading ^ would invert the set and a trailing \ would escape the closing ]
+            if parts[0].startswith("^") and not self.is_inverted:
+                parts[0] = "\\" + parts[0]
+            if parts[-1] == "\\":
+                parts[-1] = "\\\\"
 
         if self.is_inverted:
-            pattern = "^" + pattern
+            parts.insert(0, "^")
+
+        pattern = "".join(parts)
 
         if len(pattern) == 0:
             return ""
@@ -523,31 +1231,41 @@ class CharSet (RegexNode):
 
 # TODO: Add optimisation
 class Range (RegexNode):
+    _fields = ("from_char", "to_char")
+    __slots__ = _fields
+
     def __init__(self, from_char, to_char):
         self.from_char = from_char
         self.to_char = to_char
 
-    def optimised(self) -> "RegexNode":
+    def _optimise(self) -> "RegexNode":
         if self.from_char == self.to_char:
-            return SingleChar(self.from_char)
+            # A lone dash could form a range with merged chars around it: a|[---]|b --> [a\-b]
+            if self.from_char == "-":
+                return _ESCAPED_DASH
+            return SingleChar.get(self.from_char)
         return self
 
-    def regex(self, as_atom=False, in_sequence=True) -> str:
+    def _body(self):
         return self.from_char + "-" + self.to_char
 
 
 class RepeatExactlyN (RegexNode):
+    _fields = ("pattern", "n", "is_lazy")
+    __slots__ = _fields
+    _wrapped_when = "as_atom"
+
     def __init__(self, pattern, n, is_lazy=False):
         self.pattern = pattern
         self.n = n
         self.is_lazy = is_lazy
 
-    def optimised(self) -> "RegexNode":
-        if type(self.pattern) is EmptyNode:
-            return EmptyNode()
+    def _optimise(self) -> "RegexNode":
+        if self.pattern is _EMPTY:
+            return _EMPTY
 
         if self.n == 0:
-            return EmptyNode()
+            return _EMPTY
 
         optimised = self.pattern.optimised()
 
@@ -556,70 +1274,64 @@ class RepeatExactlyN (RegexNode):
 
         return RepeatExactlyN(optimised, self.n, self.is_lazy)
 
-    def regex(self, as_atom=False, in_sequence=True) -> str:
-        regex = self.pattern.regex(as_atom=True)
+    def _body(self):
+        regex = yield self.pattern, True, True
 
         if regex == "":
             return ""
 
-        regex += "{" + str(self.n) + "}"
-
-        if self.is_lazy:
-            regex += "?"
-
-        if as_atom:
-            return "(?:" + regex + ")"
-        return regex
+        return f"{regex}{{{self.n}}}{_LAZY_SUFFIX[self.is_lazy]}"
 
 
 class RepeatAtLeastN (RegexNode):
+    _fields = ("pattern", "n", "is_lazy")
+    __slots__ = _fields
+    _wrapped_when = "as_atom"
+
     def __init__(self, pattern, n, is_lazy):
         self.pattern = pattern
         self.n = n
         self.is_lazy = is_lazy
 
-    def optimised(self) -> "RegexNode":
-        if type(self.pattern) is EmptyNode:
-            return EmptyNode()
+    def _optimise(self) -> "RegexNode":
+        if self.pattern is _EMPTY:
+            return _EMPTY
 
         optimised = self.pattern.optimised()
 
         if self.n == 0:
-            return ZeroOrMore(optimised)
+            return ZeroOrMore(optimised, is_lazy=self.is_lazy)
 
         if self.n == 1:
-            return OneOrMore(optimised)
+            return OneOrMore(optimised, is_lazy=self.is_lazy)
 
         return RepeatAtLeastN(optimised, self.n, self.is_lazy)
 
-    def regex(self, as_atom=False, in_sequence=True) -> str:
-        regex = self.pattern.regex(as_atom=True)
+    def _body(self):
+        regex = yield self.pattern, True, True
 
         if regex == "":
             return ""
 
-        regex += "{" + str(self.n) + ",}"
-
-        if self.is_lazy:
-            regex += "?"
-
-        if as_atom:
-            return "(?:" + regex + ")"
-        return regex
+        return f"{regex}{{{self.n},}}{_LAZY_SUFFIX[self.is_lazy]}"
 
 
 class RepeatAtMostN (RegexNode):
+    _fields = ("pattern", "n", "is_lazy")
+    __slots__ = _fields
+    _wrapped_when = "as_atom"
+
     def __init__(self, pattern, n, is_lazy=False):
         self.pattern = pattern
         self.n = n
         self.is_lazy = is_lazy
 
-    def optimised(self) -> "RegexNode":
-        if type(self.pattern) is EmptyNode:
-            return EmptyNode()
+    def _optimise(self) -> "RegexNode":
+        if self.pattern is _EMPTY:
+            return _EMPTY
 
         if self.n == 0:
-            return EmptyNode()
+            return _EMPTY
 
         optimised = self.pattern.optimised()
 
@@ -628,32 +1340,29 @@ class RepeatAtMostN (RegexNode):
 
         return RepeatAtMostN(optimised, self.n, self.is_lazy)
 
-    def regex(self, as_atom=False, in_sequence=True) -> str:
-        regex = self.pattern.regex(as_atom=True)
+    def _body(self):
+        regex = yield self.pattern, True, True
 
         if regex == "":
             return ""
 
-        regex += "{," + str(self.n) + "}"
-
-        if self.is_lazy:
-            regex += "?"
-
-        if as_atom:
-            return "(?:" + regex + ")"
-        return regex
+        return f"{regex}{{,{self.n}}}{_LAZY_SUFFIX[self.is_lazy]}"
 
 
 class RepeatBetweenNM (RegexNode):
+    _fields = ("pattern", "n", "m", "is_lazy")
+    __slots__ = _fields
+    _wrapped_when = "as_atom"
+
     def __init__(self, pattern, n, m, is_lazy=False):
         self.pattern = pattern
         self.n = n
         self.m = m
         self.is_lazy = is_lazy
 
-    def optimised(self) -> "RegexNode":
-        if type(self.pattern) is EmptyNode:
-            return EmptyNode()
+    def _optimise(self) -> "RegexNode":
+        if self.pattern is _EMPTY:
+            return _EMPTY
 
         optimised = self.pattern.optimised()
 
@@ -661,24 +1370,17 @@ class RepeatBetweenNM (RegexNode):
             return RepeatExactlyN(optimised, self.n, is_lazy=self.is_lazy)
 
         if self.m == 0:
-            return EmptyNode()
+            return _EMPTY
 
         if self.m == 1:
-            return Optional(optimised, is_lazy=self.n==0)
+            return Optional(optimised, is_lazy=self.is_lazy)
 
         return RepeatBetweenNM(optimised, self.n, self.m, self.is_lazy)
 
-    def regex(self, as_atom=False, in_sequence=True) -> str:
-        regex = self.pattern.regex(as_atom=True)
+    def _body(self):
+        regex = yield self.pattern, True, True
 
         if regex == "":
             return ""
 
-        regex += "{" + str(self.n) + "," + str(self.m) + "}"
-
-        if self.is_lazy:
-            regex += "?"
-
-        if as_atom:
-            return "(?:" + regex + ")"
-        return regex
+        return f"{regex}{{{self.n},{self.m}}}{_LAZY_SUFFIX[self.is_lazy]}"
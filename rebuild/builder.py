@@ -1,5 +1,7 @@
 
 import re
+import sys
+import functools
 import rebuild.parser
 import rebuild.analyser
 
@@ -38,6 +40,14 @@ ReBuild transforms the OR of individual characters into a single character set
 # TODO: Add functions to disable & enable the intermediate optimisations
 INTERMEDIATE_OPTIMISATION = True
 
+# Python's re only supports atomic groups (?>...) since Python 3.11, see atomic() and the atomic=True option
+ATOMIC_GROUPS_SUPPORTED = sys.version_info >= (3, 11)
+
+
+def _check_atomic_groups_supported():
+    if not ATOMIC_GROUPS_SUPPORTED:
+        raise ValueError("Atomic groups (?>...) require Python 3.11 or newer, as older versions of re cannot compile them")
+
 
 def must_begin() -> str:
     return "^"
@@ -54,7 +64,8 @@ def force_full(pattern: str) -> str:
     if pattern == "":
         return regex
 
-    return _optimise_intermediate(regex)
+    return _optimise_wrapped(regex, pattern, lambda tree: rebuild.analyser.Sequence(
+        [rebuild.analyser.AnchorStart(), tree, rebuild.analyser.AnchorEnd()]))
 
 
 def non_capture(pattern: str) -> str:
@@ -65,102 +76,198 @@ def non_capture(pattern: str) -> str:
     return f"(?:{pattern})"
 
 
-def optionally(pattern: str, check_for_empty_first=False) -> str:
-    if pattern == "":
-        return ""
+# Single characters that cannot be used as an atom on their own
+_NOT_AN_ATOM = frozenset("()[]{}|^$.*+?\\")
 
-    regex = non_capture(pattern) + "?"
-    if check_for_empty_first:
-        regex += "?"
 
-    return _optimise_intermediate(regex)
+# Single characters that cannot be put into a char set as they are
+_NOT_PLAIN_SET_CHAR = _NOT_AN_ATOM | {"-"}
 
 
-def one_or_more(pattern: str, greedy=True) -> str:
-    if pattern == "":
-        return ""
+def _end_of_char_set(pattern: str, start: int) -> int:
+    """Returns the index of the ] that closes the char set beginning at start"""
+    i = start + 1
+    # A ] at the start of a char set (e.g. []a] or [^]a]) is a literal character
+    if pattern.startswith("^", i):
+        i += 1
+    if pattern.startswith("]", i):
+        i += 1
 
-    regex = non_capture(pattern) + "+"
+    while i < len(pattern) and pattern[i] != "]":
+        i += 2 if pattern[i] == "\\" else 1
 
-    if not greedy:
-        regex += "?"
+    return i
 
-    return _optimise_intermediate(regex)
 
+# A whole char set in one pass: [, an optional ^, an optional leading ] (e.g. []a] is a literal ]),
+# then anything but an unescaped ] up to the closing ]. The lookahead rules out [] and [^], which are unterminated
+_CHAR_SET = re.compile(r"\[(?!\^?\]\Z)\^?\]?(?:[^\]\\]|\\.)*\]", re.DOTALL)
 
-def at_least_n_times(n: int, pattern: str, greedy=True) -> str:
-    if pattern == "":
-        return ""
 
-    regex = f"{non_capture(pattern)}" + "{" + str(n) + ",}"
+def _is_char_set(pattern: str) -> bool:
+    """Checks if the whole pattern is a single char set, e.g. [a-z] but not [a][b]"""
+    # Most patterns are not char sets at all
+    return pattern[:1] == "[" and _CHAR_SET.fullmatch(pattern) is not None
 
-    if not greedy:
-        regex += "?"
 
-    return _optimise_intermediate(regex)
+def _is_only_in_group(pattern: str) -> bool:
+    """Checks if the whole pattern is enclosed by a single group, e.g. (?:a|b) but not (a)|(b)"""
+    if len(pattern) < 2 or pattern[0] != "(" or pattern[-1] != ")":
+        return False
 
+    # Scans the pattern once, skipping escaped characters and the contents of char sets
+    last = len(pattern) - 1
+    depth = 0
+    i = 0
+    while i <= last:
+        char = pattern[i]
 
-def exactly_n_times(n: int, pattern: str) -> str:
-    if pattern == "":
-        return ""
+        if char == "\\":
+            i += 2
+            continue
 
-    regex = f"{non_capture(pattern)}" + "{" + str(n) + "}"
+        if char == "[":
+            i = _end_of_char_set(pattern, i)
+        elif char == "(":
+            depth += 1
+        elif char == ")":
+            depth -= 1
+            # The first group ends before the end of the pattern
+            if depth == 0 and i != last:
+                return False
 
-    return _optimise_intermediate(regex)
+        i += 1
 
+    return depth == 0
 
-def at_least_n_but_not_more_than_m_times(n: int, m: int, pattern: str, greedy=True) -> str:
-    if pattern == "":
-        return ""
 
-    regex = f"{non_capture(pattern)}" + "{" + str(n) + "," + str(m) + "}"
-    if not greedy:
-        regex += "?"
+# Groups that can be quantified directly: (...), (?:...), lookarounds, (?P<name>...), (?P=name) and (?(name)...)
+# Other groups starting with (? are inline flags or comments, e.g. (?i) or (?#...)
+_QUANTIFIABLE_GROUP_STARTS = frozenset(":=!<P(")
 
-    _optimise_intermediate(regex)
 
+# Escaped letters that match a single character, both inside and outside of char sets (unlike e.g. \\b)
+_SET_CHAR_ESCAPES = frozenset("dDsSwWnrtfv")
 
-def at_most_n_times(n: int, pattern: str, greedy=True) -> str:
-    if pattern == "":
-        return ""
 
-    regex = f"{non_capture(pattern)}" + "{," + str(n) + "}"
+def _is_set_char(pattern: str) -> bool:
+    """Checks if the pattern is a single character that can be put into a char set as it is, e.g. a or \\d"""
+    if len(pattern) == 1:
+        return pattern not in _NOT_PLAIN_SET_CHAR
 
-    if not greedy:
-        regex += "?"
+    # Escaped symbols (e.g. \\. or \\-) are literal characters
+    return len(pattern) == 2 and pattern[0] == "\\" and (pattern[1] in _SET_CHAR_ESCAPES or not pattern[1].isalnum())
 
-    return _optimise_intermediate(regex)
+
+# Builder functions are often called with the same sub-patterns, e.g. digit() or letter()
+@functools.lru_cache(maxsize=4096)
+def _atom(pattern: str) -> str:
+    # Single characters already are atoms
+    if len(pattern) == 1 and pattern not in _NOT_AN_ATOM:
+        return pattern
+
+    if _is_char_set(pattern):
+        return pattern
+
+    # Groups already are atoms, e.g. (?:ab) does not have to become (?:(?:ab))
+    if _is_only_in_group(pattern) and (pattern[1] != "?" or pattern[2] in _QUANTIFIABLE_GROUP_STARTS):
+        return pattern
+
+    # Only wraps the pattern without optimising it on its own,
+    # as the whole resulting pattern is optimised in one go afterwards
+    return f"(?:{pattern})"
 
 
-def zero_or_more(pattern: str, greedy=True) -> str:
+def _quantify(pattern: str, quantifier: str, node, greedy=True, atomic=False) -> str:
+    """Quantifies the pattern, e.g. _quantify("ab", "+", OneOrMore) --> (?:ab)+
+    node(tree, is_lazy) creates the quantifier node, which is used instead of parsing the quantified pattern
+    again if the tree of the pattern is already known (see _optimise_wrapped)
+    """
     if pattern == "":
         return ""
 
-    regex = non_capture(pattern) + "*"
+    regex = f"{_atom(pattern)}{quantifier}{'' if greedy else '?'}"
+    if atomic:
+        _check_atomic_groups_supported()
+        regex = f"(?>{regex})"
+        return _optimise_wrapped(regex, pattern, lambda tree: rebuild.analyser.AtomicGroup(node(tree, not greedy)))
 
-    if not greedy:
-        regex += "?"
+    return _optimise_wrapped(regex, pattern, lambda tree: node(tree, not greedy))
+
+
+def optionally(pattern: str, check_for_empty_first=False) -> str:
+    return _quantify(pattern, "?", rebuild.analyser.Optional, greedy=not check_for_empty_first)
+
+
+def one_or_more(pattern: str, greedy=True, atomic=False) -> str:
+    return _quantify(pattern, "+", rebuild.analyser.OneOrMore, greedy, atomic)
+
+
+def at_least_n_times(n: int, pattern: str, greedy=True, atomic=False) -> str:
+    return _quantify(
+        pattern, f"{{{n},}}", lambda tree, is_lazy: rebuild.analyser.RepeatAtLeastN(tree, n, is_lazy), greedy, atomic)
+
+
+def exactly_n_times(n: int, pattern: str, atomic=False) -> str:
+    return _quantify(
+        pattern, f"{{{n}}}", lambda tree, is_lazy: rebuild.analyser.RepeatExactlyN(tree, n), atomic=atomic)
+
+
+def at_least_n_but_not_more_than_m_times(n: int, m: int, pattern: str, greedy=True, atomic=False) -> str:
+    if n > m:
+        # Invalid, but left to re to report
+        return _optimise_intermediate(f"{_atom(pattern)}{{{n},{m}}}")
+
+    return _quantify(
+        pattern, f"{{{n},{m}}}", lambda tree, is_lazy: rebuild.analyser.RepeatBetweenNM(tree, n, m, is_lazy),
+        greedy, atomic)
 
-    return _optimise_intermediate(regex)
+
+def at_most_n_times(n: int, pattern: str, greedy=True, atomic=False) -> str:
+    return _quantify(
+        pattern, f"{{,{n}}}", lambda tree, is_lazy: rebuild.analyser.RepeatAtMostN(tree, n, is_lazy), greedy, atomic)
+
+
+def zero_or_more(pattern: str, greedy=True, atomic=False) -> str:
+    return _quantify(pattern, "*", rebuild.analyser.ZeroOrMore, greedy, atomic)
 
 
 def either(*groups) -> str:
-    # Filter out empty strings
-    groups = list(filter(None, groups))
+    # Filter out empty strings and duplicates, keeping the first occurrence of every group
+    groups = list(dict.fromkeys(filter(None, groups)))
 
     if len(groups) == 0:
         return ""
 
-    regex = non_capture("|".join(non_capture(group) for group in groups))
+    # Alternatives of single characters are a char set, e.g. either("a", "b", "c") --> [abc]
+    # or either("\\d", "_") --> [\d_]
+    if INTERMEDIATE_OPTIMISATION and all(map(_is_set_char, groups)):
+        chars = "".join(groups)
+        return groups[0] if len(groups) == 1 else f"[{chars}]"
+
+    regex = _atom("|".join([_atom(group) for group in groups]))
     return _optimise_intermediate(regex)
 
 
+# Atomic groups (and the atomic=True option of the quantifiers) require Python 3.11+ (or PCRE flavoured regex),
+# on older versions they raise a ValueError (see ATOMIC_GROUPS_SUPPORTED).
+# Once an atomic group has matched, the engine does not backtrack into it, e.g. (?>a+)b fails faster on "aaaa...c"
+def atomic(pattern: str) -> str:
+    if pattern == "":
+        return ""
+
+    _check_atomic_groups_supported()
+
+    regex = f"(?>{pattern})"
+    return _optimise_wrapped(regex, pattern, rebuild.analyser.AtomicGroup)
+
+
 def lookahead(pattern: str) -> str:
     if pattern == "":
         return ""
 
     regex = f"(?={pattern})"
-    return _optimise_intermediate(regex)
+    return _optimise_wrapped(regex, pattern, rebuild.analyser.Lookahead)
 
 
 def negative_lookahead(pattern: str) -> str:
@@ -168,7 +275,7 @@ def negative_lookahead(pattern: str) -> str:
         return ""
 
     regex = f"(?!{pattern})"
-    return _optimise_intermediate(regex)
+    return _optimise_wrapped(regex, pattern, rebuild.analyser.NegativeLookahead)
 
 
 def lookbehind(pattern: str) -> str:
@@ -187,27 +294,31 @@ def negative_lookbehind(pattern: str) -> str:
     return _optimise_intermediate(regex)
 
 
-def _literally_char(character):
-    if re.match(r"[.\[\]*+?]", character):
-        return "\\" + character
+# Characters that are escaped by literally (the ones re.escape escapes and ")
+_ESCAPED_BY_LITERALLY = frozenset("()[]{}?*+-|^$\\.&~# \t\n\r\v\f\"")
 
-    return character
+# Escapes all of these characters in a single str.translate pass
+_LITERALLY_TABLE = str.maketrans({char: "\\" + char for char in _ESCAPED_BY_LITERALLY})
 
 
 # If it is not Python flavoured Regex, then this should be updated to check for more characters
+@functools.lru_cache(maxsize=2048)
 def literally(pattern: str) -> str:
-    literal = re.escape(pattern)
-    literal = re.sub("\"", "\\\"", literal)
-    # literal = "".join([_literally_char(char) for char in pattern])
-    return literal
+    # Most literals (e.g. words) do not contain any special characters
+    if _ESCAPED_BY_LITERALLY.isdisjoint(pattern):
+        return pattern
+
+    # Same as re.escape, but also escapes "
+    return pattern.translate(_LITERALLY_TABLE)
 
 
 def capture(pattern: str, name: str = None) -> str:
     if name is None:
         regex = f"({pattern})"
-    else:
-        regex = f"(?P<{name}>{pattern})"
+        return _optimise_wrapped(regex, pattern, rebuild.analyser.CapturingGroup)
 
+    # Named groups are always parsed, so that invalid names are reported by re
+    regex = f"(?P<{name}>{pattern})"
     return _optimise_intermediate(regex)
 
 
@@ -240,6 +351,10 @@ def not_one_of(possible_characters: str) -> str:
     return _optimise_intermediate(regex)
 
 
+# Inline modifier of every flag of mode(), in the order of its parameters
+_MODE_MODIFIERS = "uaixmLs"
+
+
 def mode(pattern: str,
          unicode=False,
          ascii=False,
@@ -249,14 +364,8 @@ def mode(pattern: str,
          locale_dependant=False,
          dotall=False) -> str:
 
-    modifiers = ""
-    if unicode:     modifiers += "u"
-    if ascii:       modifiers += "a"
-    if ignore_case: modifiers += "i"
-    if verbose:     modifiers += "x"
-    if multiline:   modifiers += "m"
-    if locale_dependant: modifiers += "L"
-    if dotall:      modifiers += "s"
+    flags = (unicode, ascii, ignore_case, verbose, multiline, locale_dependant, dotall)
+    modifiers = "".join(char for char, is_active in zip(_MODE_MODIFIERS, flags) if is_active)
 
     # Must have at least one modifier active!
     assert len(modifiers) > 0
@@ -291,7 +400,7 @@ def anything() -> str:
 
 
 def if_group_exists_then_else(name: str, then: str, elsewise: str) -> str:
-    regex = f"(?({name}){non_capture(then)}|{non_capture(elsewise)})"
+    regex = f"(?({name}){_atom(then)}|{_atom(elsewise)})"
 
     return _optimise_intermediate(regex)
 
@@ -330,17 +439,94 @@ def group(pattern):
     return non_capture(pattern)
 
 
+@functools.lru_cache(maxsize=256)
+def compiled(pattern: str, flags: int = 0) -> "re.Pattern":
+    """Compiles the pattern with re.compile. Identical patterns share the same compiled object."""
+    return re.compile(pattern, flags)
+
+
+# Optimised trees of the patterns that were passed into and returned by the builder functions. Building
+# patterns bottom-up passes the same patterns around many times (e.g. group(either(...)) or optimise(...)),
+# which then do not have to be parsed and optimised again.
+_KNOWN_TREES_LIMIT = 4096
+_known_trees = {}
+
+
+def _remember_tree(pattern: str, tree: "rebuild.analyser.RegexNode"):
+    if len(_known_trees) >= _KNOWN_TREES_LIMIT:
+        # Forget the least recently used pattern
+        del _known_trees[next(iter(_known_trees))]
+
+    _known_trees[pattern] = tree
+
+
+def _optimised_tree(regex: str) -> "rebuild.analyser.RegexNode":
+    tree = _known_trees.pop(regex, None)
+    if tree is not None:
+        # Move the pattern to the end, so that often used patterns (e.g. digit()) are kept the longest
+        _known_trees[regex] = tree
+        return tree
+
+    tree = rebuild.parser.regex_to_tree(regex).optimised()
+    _remember_tree(regex, tree)
+    _remember_tree(tree.regex(as_atom=False), tree)
+    return tree
+
+
+def clear_caches():
+    """Forgets all cached trees (parsed and optimised), atoms, literals and compiled patterns"""
+    _known_trees.clear()
+    rebuild.parser.regex_to_tree.cache_clear()
+    _atom.cache_clear()
+    literally.cache_clear()
+    compiled.cache_clear()
+
+
+# Characters that start the only structures the optimiser can change: alternations, char sets, groups and quantifiers
+_OPTIMISABLE_SYNTAX = frozenset("|[(){}*+?")
+
+
 def _optimise_intermediate(regex: str):
     if not INTERMEDIATE_OPTIMISATION:
         return regex
 
-    tree = rebuild.parser.regex_to_tree(regex)
-    optimised = tree.optimised()
-    return optimised.regex(as_atom=False)
+    # Plain sequences of characters, escapes and anchors (e.g. abc or ^\d\.$) cannot be optimised any further,
+    # but they are still validated (e.g. a\ or \q), same as the patterns that are parsed
+    if _OPTIMISABLE_SYNTAX.isdisjoint(regex):
+        re.compile(regex)
+        return regex
+
+    # The generated pattern is cached by the tree itself
+    return _optimised_tree(regex).regex(as_atom=False)
+
+
+def _optimise_wrapped(regex: str, pattern: str, wrap) -> str:
+    """Optimises regex, which is the given pattern wrapped in a group or anchors.
+    If the pattern was returned by another builder function, its optimised tree is already known,
+    so wrap(tree) is optimised directly instead of parsing the whole pattern again.
+    Only used for wrappers that cannot make a valid pattern invalid (unlike e.g. lookbehinds).
+    """
+    if not INTERMEDIATE_OPTIMISATION:
+        return regex
+
+    tree = _known_trees.get(pattern)
+    # Only for optimised patterns, as e.g. ^a|b$ is not the same as ^[ab]$
+    if tree is None or tree.regex(as_atom=False) != pattern:
+        return _optimise_intermediate(regex)
+
+    tree = wrap(tree).optimised()
+    optimised = tree.regex(as_atom=False)
+    _remember_tree(regex, tree)
+    _remember_tree(optimised, tree)
+    return optimised
 
 
 def optimise(regex: str, is_root=True):
-    tree = rebuild.parser.regex_to_tree(regex)
-    optimised = tree.optimised()
+    if is_root and _OPTIMISABLE_SYNTAX.isdisjoint(regex):
+        # Already minimal, so there is no need to parse it (but it is still validated)
+        re.compile(regex)
+        return regex
+
+    optimised = _optimised_tree(regex)
 
     return optimised.regex(as_atom=(not is_root), in_sequence=(not is_root))
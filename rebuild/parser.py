@@ -1,14 +1,20 @@
 
-from lark import Lark, Transformer, Tree, Token
+import re
+import functools
+from lark import Lark, Transformer, Token
 from rebuild.analyser import *
+from rebuild.analyser import _EMPTY
 
 
 regex_grammar = r"""
     ?main: alternation
          | sequence
     
-    alternation: alternation_matches_empty? sequence ("|" sequence)* "|" sequence
-    alternation_matches_empty: "|"
+    // Any option can be empty, e.g. a| or (?:|a)
+    alternation: option ("|" option)+
+    ?option: sequence
+           | empty_option
+    empty_option:
     
     ?sequence: (quantified | atom)+
     
@@ -17,21 +23,22 @@ regex_grammar = r"""
                | repeat
                | optional
     
-    one_or_more: atom "+" is_lazy?
-    zero_or_more: atom "*" is_lazy?
-    optional: atom "?" is_lazy?
+    one_or_more: atom "+" LAZY?
+    zero_or_more: atom "*" LAZY?
+    optional: atom "?" LAZY?
     
     ?repeat: repeat_exactly_n
            | repeat_at_least_n
            | repeat_at_most_n
            | repeat_between_n_m
     
-    is_lazy: "?"
+    // A trailing ? is kept as a token, so that the quantifiers only have to check whether it is there
+    LAZY: "?"
     
-    repeat_exactly_n:   atom "{" /\d+/ "}" is_lazy?
-    repeat_at_least_n:  atom "{" /\d+/ ",}" is_lazy?
-    repeat_at_most_n:   atom "{," /\d+/ "}" is_lazy?
-    repeat_between_n_m: atom "{" /\d+/ "," /\d+/ "}" is_lazy?
+    repeat_exactly_n:   atom "{" /\d+/ "}" LAZY?
+    repeat_at_least_n:  atom "{" /\d+/ ",}" LAZY?
+    repeat_at_most_n:   atom "{," /\d+/ "}" LAZY?
+    repeat_between_n_m: atom "{" /\d+/ "," /\d+/ "}" LAZY?
     
     ?atom: char_set
          | backreference
@@ -40,43 +47,46 @@ regex_grammar = r"""
          | single_char
          | anchor
     
-    // TODO: Split this into two rules:
-    // one for normal characters
-    // and one for char sets
-    single_char: /\w/
-               | /\\[^\d]/
-               | /\s/
-               | HEX_CHARACTER
-               | UNICODE_CHARACTER
+    single_char: SINGLE_CHAR
                | PLUS
-               | MINUS
                | ASTERISK
-               | /[^\n^$]/
     
-    UNICODE_CHARACTER: /\\u\d{4}/
-    HEX_CHARACTER: /\\x[a-fA-F0-9]{2}/
+    // Chars inside of char sets have their own rule, so that the parser states of char sets and sequences
+    // are never merged. Thereby the lexer only looks for ranges inside of char sets (a-b is no range in a sequence)
+    // The rule is inlined, so char_set receives the tokens directly
+    ?set_char: SINGLE_CHAR
+            | PLUS
+            | ASTERISK
+            | DOLLAR
+    
+    // Escaped characters (e.g. \u0041, \x41, \d) and literal characters are matched by the lexer in one go.
+    // The lower priority makes the lexer try the other terminals (e.g. "(?:", ranges) first.
+    SINGLE_CHAR.0: /\\u[a-fA-F0-9]{4}|\\x[a-fA-F0-9]{2}|\\[^\d]|\s|[^\n^$]/
     PLUS: "+"
-    MINUS: "-"
     ASTERISK: "*"
-    DIGIT: /\d/
     CARET: "^"
     DOLLAR: "$"
     
     anchor: CARET | DOLLAR
     
-    char_set: "[" CARET (range | single_char | CARET | DOLLAR)+ "]"
-           | "[" (range | single_char) (range | single_char | CARET | DOLLAR)* "]"
-
-    range: /[a-z]-[a-z]/
-         | /[A-Z]-[A-Z]/
-         | /[0-9]-[0-9]/
-         | /\\u\d{4}-\\u\d{4}/
-         | /\\x[a-fA-F0-9]{2}-\\x[a-fA-F0-9]{2}/
+    char_set: "[" CARET (inverted_first_range | set_char | CARET) (range | set_char | CARET)* "]"
+            | "[" (first_range | set_char) (range | set_char | CARET)* "]"
+    
+    // Ranges between any two chars, e.g. a-z, \x41-\x5A or %-+
+    // What the first char can be depends on the position: ] only starts a range at the beginning of a set ([]-a])
+    // and ^ everywhere but directly after the opening bracket, where it inverts the set ([^-a] is no range)
+    range: RANGE
+    first_range: FIRST_RANGE
+    inverted_first_range: INVERTED_FIRST_RANGE
+    RANGE: /(?:\\u[a-fA-F0-9]{4}|\\x[a-fA-F0-9]{2}|\\[^\d]|[^\\\]\n])-(?:\\u[a-fA-F0-9]{4}|\\x[a-fA-F0-9]{2}|\\[^\d]|[^\\\]\n])/
+    FIRST_RANGE: /(?:\\u[a-fA-F0-9]{4}|\\x[a-fA-F0-9]{2}|\\[^\d]|[^\\^\n])-(?:\\u[a-fA-F0-9]{4}|\\x[a-fA-F0-9]{2}|\\[^\d]|[^\\\]\n])/
+    INVERTED_FIRST_RANGE: /(?:\\u[a-fA-F0-9]{4}|\\x[a-fA-F0-9]{2}|\\[^\d]|[^\\\n])-(?:\\u[a-fA-F0-9]{4}|\\x[a-fA-F0-9]{2}|\\[^\d]|[^\\\]\n])/
     
     ?group: if_else_group
           | non_capturing_group
           | named_capturing_group
           | mode
+          | atomic_group
           | capturing_group
     
     if_else_group: "(?(" /\w+/ ")" sequence? "|" sequence? ")"
@@ -98,124 +108,176 @@ regex_grammar = r"""
     
     mode: "(?" /[aiLmsux]+/ ":" main ")"
     
+    atomic_group: "(?>" main? ")"
+    
     ?backreference: named_backreference
                   | numbered_backreference
     
-    numbered_backreference: "\\" /\d+/
+    numbered_backreference: /\\\d+/
     named_backreference: "(P=" /\w+/ ")"
 """
 
 
-def _get_single_child(items):
-    if len(items) == 0:
-        return EmptyNode()
-    child = items[0]
+def _only_child(children):
+    # Groups like (?:) or (?=) have no child at all
+    return children[0] if children else _EMPTY
 
-    if type(child) is Token:
-        return str(child)
-    if type(child) is Tree:
-        return str(child)
-    return child
 
+def _is_lazy(children, count):
+    # The LAZY token is the only optional child of a quantifier, so it is there if there is one more child
+    return len(children) > count
 
-def _one_child(cls, look_for_lazy=False):
-    if look_for_lazy:
-        return lambda _, items: cls(_get_single_child(items), is_lazy=_is_lazy(items))
-    return lambda _, items: cls(_get_single_child(items))
 
+def _repeat(node_class, children):
+    # {n}, {n,}, {,n} and {n,m} only differ in their counts, which are all children between the pattern and LAZY
+    pattern, *counts = children
+    is_lazy = counts[-1].type == "LAZY"
+    if is_lazy:
+        counts.pop()
 
-def _is_lazy(items):
-    return any([type(item) is Tree and item.data == "is_lazy" for item in items])
+    return node_class(pattern, *map(int, counts), is_lazy)
 
 
+# The callbacks get the list of children directly (no v_args), as inlining them costs two extra calls per node
 class ParseTreeTransformer (Transformer):
-    alternation = Alternation
-    sequence = Sequence
-    single_char = _one_child(SingleChar)
-    one_or_more = _one_child(OneOrMore, look_for_lazy=True)
-    zero_or_more = _one_child(ZeroOrMore, look_for_lazy=True)
-    optional = _one_child(Optional, look_for_lazy=True)
-
-    lookahead = _one_child(Lookahead)
-    negative_lookahead = _one_child(NegativeLookahead)
-    lookbehind = _one_child(Lookbehind)
-    neagtive_lookbehind = _one_child(NegativeLookbehind)
-
-    named_capturing_group = lambda _, items: NamedCapturingGroup(str(items[0]), _get_single_child(items[1:]))
-    capturing_group = _one_child(CapturingGroup)
-    non_capturing_group = _one_child(NonCapturingGroup)
-    anchor = lambda _, items: AnchorStart() if items[0] == "^" else AnchorEnd()
-
-    def mode(self, items):
-        modifiers = str(items[0])
-        pattern = _get_single_child(items[1:])
-        return ModeGroup(modifiers, pattern)
-
-    def range(self, items):
-        from_char, to_char = items[0].split("-")
-        return Range(from_char, to_char)
+    def alternation(self, options):
+        # Nested alternations are spliced in right away, as non-capturing groups have no meaning
+        # (?:a|(?:b|c)) --> (?:a|b|c)
+        flattened = []
+        for option in options:
+            if type(option) is Alternation:
+                flattened.extend(option.options)
+            else:
+                flattened.append(option)
 
-    def char_set(self, items):
-        def _is_tok(tok, *possible_names):
-            return type(tok) is Token and tok.type in possible_names
+        return Alternation(flattened)
+
+    def empty_option(self, children):
+        return _EMPTY
+
+    def sequence(self, items):
+        return Sequence(items)
+
+    def single_char(self, children):
+        # Tokens are strs, so they can be looked up directly. Only new nodes convert them (see SingleChar.get)
+        return SingleChar.get(children[0])
+
+    def anchor(self, children):
+        return AnchorStart() if children[0] == "^" else AnchorEnd()
+
+    def one_or_more(self, children):
+        return OneOrMore(children[0], _is_lazy(children, 1))
+
+    def zero_or_more(self, children):
+        return ZeroOrMore(children[0], _is_lazy(children, 1))
+
+    def optional(self, children):
+        return Optional(children[0], _is_lazy(children, 1))
+
+    def lookahead(self, children):
+        return Lookahead(_only_child(children))
+
+    def negative_lookahead(self, children):
+        return NegativeLookahead(_only_child(children))
+
+    def lookbehind(self, children):
+        return Lookbehind(_only_child(children))
+
+    def negative_lookbehind(self, children):
+        return NegativeLookbehind(_only_child(children))
+
+    def named_capturing_group(self, children):
+        name, *pattern = children
+        return NamedCapturingGroup(str(name), _only_child(pattern))
 
-        if _is_tok(items[0], "CARET"):
-            is_inverted = True
+    def capturing_group(self, children):
+        return CapturingGroup(_only_child(children))
+
+    def non_capturing_group(self, children):
+        return NonCapturingGroup(_only_child(children))
+
+    def mode(self, children):
+        modifiers, pattern = children
+        return ModeGroup(str(modifiers), pattern)
+
+    def atomic_group(self, children):
+        return AtomicGroup(_only_child(children))
+
+    def range(self, children):
+        token = children[0]
+        # The end of the first char is known from its first characters (e.g. a-z, \x41-\x5A or \--/),
+        # so both chars can be sliced out directly
+        if token[0] != "\\":
+            length = 1
+        elif token[1] == "x":
+            length = 4
+        elif token[1] == "u":
+            length = 6
         else:
-            is_inverted = False
+            length = 2
+
+        return Range(token[:length], token[length + 1:])
+
+    first_range = range
+    inverted_first_range = range
+
+    def char_set(self, items):
+        first = items[0]
+        is_inverted = type(first) is Token and first.type == "CARET"
 
         if is_inverted:
             items = items[1:]
 
-        items = [SingleChar(str(item)) if _is_tok(item, "CARET", "DOLLAR") else item for item in items]
+        # Chars (including carets after the first item) are still tokens, only ranges are already nodes
+        items = [SingleChar.get(item) if type(item) is Token else item for item in items]
 
         return CharSet(items, is_inverted)
 
-    def repeat_exactly_n(self, items):
-        pattern = _get_single_child(items)
-        n = int(items[1])
-        is_lazy = _is_lazy(items)
-        return RepeatExactlyN(pattern, n, is_lazy)
-
-    def repeat_at_least_n(self, items):
-        pattern = _get_single_child(items)
-        n = int(items[1])
-        is_lazy = _is_lazy(items)
-        return RepeatAtLeastN(pattern, n, is_lazy)
-
-    def repeat_at_most_n(self, items):
-        pattern = _get_single_child(items)
-        n = int(items[1])
-        is_lazy = _is_lazy(items)
-        return RepeatAtMostN(pattern, n, is_lazy)
-
-    def repeat_between_n_m(self, items):
-        pattern = _get_single_child(items)
-        n = int(items[1])
-        m = int(items[2])
-        is_lazy = _is_lazy(items)
-        return RepeatBetweenNM(pattern, n, m, is_lazy)
-
-    def if_else_group(self, items):
-        name = str(items[0])
-        then = _get_single_child(items[1:])
-        elsewise = _get_single_child(items[2:])
-        return IfElseGroup(name, then, elsewise)
+    def repeat_exactly_n(self, children):
+        return _repeat(RepeatExactlyN, children)
+
+    def repeat_at_least_n(self, children):
+        return _repeat(RepeatAtLeastN, children)
+
+    def repeat_at_most_n(self, children):
+        return _repeat(RepeatAtMostN, children)
+
+    def repeat_between_n_m(self, children):
+        return _repeat(RepeatBetweenNM, children)
+
+    def if_else_group(self, children):
+        name, *branches = children
+        then = _only_child(branches)
+        elsewise = branches[1] if len(branches) > 1 else _EMPTY
+        return IfElseGroup(str(name), then, elsewise)
+
+    def numbered_backreference(self, children):
+        return NumberedBackreference(int(children[0][1:]))
+
+
+@functools.lru_cache(maxsize=None)
+def _debug_parser(parser_type):
+    # Built on first use only (and then reused), as building the Earley parser is slow
+    grammar = regex_grammar
+    if parser_type == "earley":
+        # The dynamic Earley lexer does not support terminal priorities
+        grammar = grammar.replace("SINGLE_CHAR.0:", "SINGLE_CHAR:")
+
+    return Lark(grammar, start=start, parser=parser_type)
 
 
 def debug_parse_tree(regex, use_lalr=True):
-    if use_lalr:
-        parser = Lark(regex_grammar, start=start, parser="lalr")
-    else:
-        parser = Lark(regex_grammar, start=start, parser="earley")
+    parser = _debug_parser("lalr" if use_lalr else "earley")
 
     tree = parser.parse(regex)
     return tree
 
 
+# Trees are never modified after parsing (optimising creates new nodes), so identical patterns can share them
+@functools.lru_cache(maxsize=1024)
 def regex_to_tree(regex) -> "RegexNode":
     if regex == "":
-        return EmptyNode()
+        return _EMPTY
 
     # Check if the regex is valid before running it through the parser => Better error messages
     re.compile(regex)
@@ -224,4 +286,15 @@ def regex_to_tree(regex) -> "RegexNode":
 
 start = "main"
 
-regex_parser = Lark(regex_grammar, start=start, parser="lalr", transformer=ParseTreeTransformer())
+# The LALR tables are cached in the temp directory (keyed on the grammar and the lark version),
+# so that the grammar analysis only has to run once and not on every import.
+# The transformer is applied while parsing, so no intermediate parse tree is built.
+# Positions and placeholders are not used by the transformer, so they are explicitly turned off.
+regex_parser = Lark(
+    regex_grammar,
+    start=start,
+    parser="lalr",
+    transformer=ParseTreeTransformer(),
+    propagate_positions=False,
+    maybe_placeholders=False,
+    cache=True)
@@ -0,0 +1,284 @@
+import itertools
+import re
+import sys
+import unittest
+
+import rebuild.builder
+from rebuild.builder import (
+    atomic, at_least_n_but_not_more_than_m_times, at_least_n_times, at_most_n_times, either, exactly_n_times,
+    force_full, non_capture, one_or_more, optimise, zero_or_more)
+
+
+# Short strings over a small alphabet, with word characters, spaces and chars that are special in char sets
+_SUBJECTS = ["".join(chars) for length in range(4) for chars in itertools.product("ab x]-^", repeat=length)]
+
+
+class OptimisationTestCase (unittest.TestCase):
+    def assertSameMatches(self, original, optimised):
+        """Checks that the optimised pattern is valid and matches the same strings as the original one"""
+        original_regex = re.compile(original)
+        optimised_regex = re.compile(optimised)
+
+        for subject in _SUBJECTS:
+            for start in range(len(subject) + 1):
+                expected = original_regex.match(subject, start)
+                actual = optimised_regex.match(subject, start)
+                self.assertEqual(
+                    expected and expected.group(0),
+                    actual and actual.group(0),
+                    f"{original!r} --> {optimised!r} on {subject!r} at {start}")
+
+    def assertOptimisesTo(self, pattern, expected):
+        optimised = optimise(pattern)
+        self.assertEqual(optimised, expected)
+        self.assertSameMatches(pattern, optimised)
+
+
+class TestPrefixes (OptimisationTestCase):
+    def test_common_prefix_of_adjacent_options(self):
+        self.assertOptimisesTo("abc|abd|xyz", "ab[cd]|xyz")
+
+    def test_prefix_of_longer_option_leaves_optional_rest(self):
+        self.assertOptimisesTo("abx|ab", "abx?")
+
+    def test_option_that_is_a_prefix_leaves_lazy_optional_rest(self):
+        self.assertOptimisesTo("a|ab", "ab??")
+
+    def test_optional_rest_is_grouped(self):
+        self.assertOptimisesTo("foobar|foo", "foo(?:bar)?")
+
+    def test_inside_sequence(self):
+        self.assertOptimisesTo("(?:ab|ax)b", "a[bx]b")
+
+
+class TestSuffixes (OptimisationTestCase):
+    def test_common_suffix_of_adjacent_options(self):
+        self.assertOptimisesTo("abc|xbc|y", "[ax]bc|y")
+
+    def test_suffix_of_longer_option_leaves_optional_rest(self):
+        self.assertOptimisesTo("ab|b", "a?b")
+
+    def test_option_that_is_a_suffix_leaves_lazy_optional_rest(self):
+        self.assertOptimisesTo("b|ab", "a??b")
+
+
+class TestZeroWidthEscapes (OptimisationTestCase):
+    def test_factored_prefix_leaves_optional_word_boundary(self):
+        self.assertOptimisesTo(r"a\b|a", r"a(?:\b)?")
+
+    def test_factored_prefix_leaves_lazy_optional_non_boundary(self):
+        self.assertOptimisesTo(r"a|a\B", r"a(?:\B)??")
+
+    def test_factored_prefix_leaves_optional_string_end(self):
+        self.assertOptimisesTo(r"x\Z|x", r"x(?:\Z)?")
+
+    def test_factored_suffix_leaves_optional_word_boundary(self):
+        self.assertOptimisesTo(r"\ba|a", r"(?:\b)?a")
+
+    def test_factored_suffix_leaves_optional_string_start(self):
+        self.assertOptimisesTo(r"\Aa|a", r"(?:\A)?a")
+
+    def test_common_prefix_can_be_an_escape(self):
+        self.assertOptimisesTo(r"\ba|\bb", r"\b[ab]")
+
+    def test_either(self):
+        pattern = either("foo\\b", "foo")
+        self.assertEqual(pattern, r"foo(?:\b)?")
+        self.assertSameMatches(r"(?:foo\b|foo)", pattern)
+
+
+class TestAnchors (OptimisationTestCase):
+    def test_factored_prefix_leaves_optional_end(self):
+        self.assertOptimisesTo("ba$|ba", "ba(?:$)?")
+
+    def test_factored_prefix_leaves_lazy_optional_start(self):
+        self.assertOptimisesTo("ba|ba^", "ba(?:^)??")
+
+    def test_factored_suffix_leaves_optional_end(self):
+        self.assertOptimisesTo("$a|a", "(?:$)?a")
+
+
+class TestBackreferences (OptimisationTestCase):
+    def test_numbered_backreference(self):
+        self.assertOptimisesTo(r"(a)\1", r"(a)\1")
+
+    def test_quantified_numbered_backreference(self):
+        self.assertOptimisesTo(r"(a|b)\1+", r"([ab])\1+")
+
+
+class TestCharSets (OptimisationTestCase):
+    def test_either_of_single_chars(self):
+        pattern = either("a", "b", "a")
+        self.assertEqual(pattern, "[ab]")
+        self.assertSameMatches("a|b|a", pattern)
+
+    def test_either_escapes_merged_dash(self):
+        pattern = either("a", "-", "b")
+        self.assertEqual(pattern, r"[a\-b]")
+        self.assertSameMatches("a|-|b", pattern)
+
+    def test_merged_closing_bracket_is_escaped(self):
+        self.assertOptimisesTo("a|]", r"[a\]]")
+
+    def test_leading_closing_bracket_is_escaped_after_merging(self):
+        self.assertOptimisesTo("b|[]a]", r"[b\]a]")
+
+    def test_leading_closing_bracket_is_kept(self):
+        self.assertOptimisesTo("[]a]|b", "[]ab]")
+
+    def test_closing_bracket_and_dash(self):
+        self.assertOptimisesTo("]|-|a", r"[]\-a]")
+
+    def test_caret_after_first_char(self):
+        self.assertOptimisesTo("[a^]|b", "[a^b]")
+
+    def test_chars_are_grouped_across_options_with_other_first_chars(self):
+        self.assertOptimisesTo("a|foo|b", "[ab]|foo")
+
+    def test_chars_are_not_grouped_across_options_that_could_match_first(self):
+        self.assertOptimisesTo("a|Bc|b", "a|Bc|b")
+
+    def test_either_groups_chars(self):
+        pattern = either("a", "foo", "b")
+        self.assertEqual(pattern, "(?:[ab]|foo)")
+        self.assertSameMatches("a|foo|b", pattern)
+
+    def test_inverted_sets_are_intersected(self):
+        self.assertOptimisesTo("[^ab]|[^bc]", "[^b]")
+        self.assertOptimisesTo("[^a-c]|[^b]", "[^b]")
+
+    def test_inverted_sets_that_differ_by_case_are_kept(self):
+        self.assertOptimisesTo("[^a]|[^A]", "[^a]|[^A]")
+
+    def test_dash_outside_of_char_set_is_no_range(self):
+        self.assertOptimisesTo("ba-b", "ba-b")
+
+    def test_range_between_any_two_chars(self):
+        self.assertOptimisesTo("[%-+]|a", "[%-+a]")
+
+    def test_range_can_start_with_caret_after_first_position(self):
+        self.assertOptimisesTo("[a^-b]", "[a^-b]")
+        self.assertOptimisesTo("[^a^-c]|[^-]", "[^a^-c]|[^-]")
+
+    def test_range_can_start_with_closing_bracket_in_first_position(self):
+        self.assertOptimisesTo("[]-a]", "[]-a]")
+        self.assertOptimisesTo("[^]-a]|[^-]", "[^]-a]|[^-]")
+
+    def test_merged_chars_around_ranges(self):
+        self.assertOptimisesTo("a|-|[]-b]", r"[a\-\]-b]")
+
+    def test_dashes_at_merged_ends_are_escaped(self):
+        self.assertOptimisesTo("[a-]|[-b]", r"[a\-b]")
+
+    def test_ranges_are_kept_when_merging(self):
+        self.assertOptimisesTo("[a^-b]|c", "[a^-bc]")
+        self.assertOptimisesTo("[]-a]|b", "[]-ab]")
+
+    def test_single_char_ranges_become_chars(self):
+        self.assertOptimisesTo("[a-a]", "a")
+        self.assertOptimisesTo("[a-ab]", "[ab]")
+        self.assertOptimisesTo("[a-aa]", "a")
+
+    def test_single_dash_range_is_escaped(self):
+        # Python warns about -- as it may become a set difference in the future
+        with self.assertWarns(FutureWarning):
+            self.assertOptimisesTo("[---a]", r"[\-a]")
+            self.assertOptimisesTo("a|[---]|b", r"[a\-b]")
+
+
+class TestQuantifiers (OptimisationTestCase):
+    def test_at_least_n_but_not_more_than_m_times(self):
+        self.assertEqual(at_least_n_but_not_more_than_m_times(2, 5, "ab"), "(?:ab){2,5}")
+        self.assertEqual(at_least_n_but_not_more_than_m_times(2, 5, "a", greedy=False), "a{2,5}?")
+
+    def test_zero_or_one_time_keeps_laziness(self):
+        self.assertEqual(at_least_n_but_not_more_than_m_times(0, 1, "ab"), "(?:ab)?")
+        self.assertEqual(at_least_n_but_not_more_than_m_times(0, 1, "ab", greedy=False), "(?:ab)??")
+        self.assertOptimisesTo("a{0,1}", "a?")
+        self.assertOptimisesTo("a{0,1}?", "a??")
+
+    def test_at_least_zero_or_one_times_keeps_laziness(self):
+        self.assertEqual(at_least_n_times(1, "ab", greedy=False), "(?:ab)+?")
+        self.assertEqual(at_least_n_times(0, "ab", greedy=False), "(?:ab)*?")
+        self.assertOptimisesTo("a{1,}", "a+")
+        self.assertOptimisesTo("a{1,}?", "a+?")
+
+
+class TestEmptyOptions (OptimisationTestCase):
+    def test_empty_option_makes_the_rest_optional(self):
+        self.assertOptimisesTo("a|", "a?")
+        self.assertOptimisesTo("(?:|a)b", "a??b")
+        self.assertOptimisesTo("(a|)", "(a?)")
+        self.assertOptimisesTo(r"(?:\b|)", r"(?:\b)?")
+
+    def test_empty_option_in_the_middle(self):
+        self.assertOptimisesTo("a||b", "a||b")
+
+    def test_nested_quantifiers_keep_empty_matches(self):
+        self.assertOptimisesTo("(?:a|)+", "a*")
+        self.assertOptimisesTo("(?:a?)+", "a*")
+
+    def test_lazy_nested_quantifiers_are_not_merged(self):
+        self.assertOptimisesTo("(?:a??)+", "(?:a??)+")
+        self.assertOptimisesTo("(?:|b+)*", "(?:(?:b+)??)*")
+
+
+class TestPlainPatterns (unittest.TestCase):
+    def test_plain_pattern_is_unchanged(self):
+        self.assertEqual(force_full("a\\.b"), "^a\\.b$")
+        self.assertEqual(non_capture("^\\d\\.$"), "(?:^\\d\\.$)")
+
+
+class TestValidation (unittest.TestCase):
+    def test_force_full_rejects_bad_escape(self):
+        with self.assertRaises(re.error):
+            force_full("\\q")
+
+    def test_non_capture_rejects_trailing_backslash(self):
+        with self.assertRaises(re.error):
+            non_capture("a\\")
+
+    def test_optimise_rejects_bad_escape(self):
+        with self.assertRaises(re.error):
+            optimise("a\\q")
+
+
+class TestAtomicGroups (unittest.TestCase):
+    def tearDown(self):
+        rebuild.builder.ATOMIC_GROUPS_SUPPORTED = sys.version_info >= (3, 11)
+
+    @unittest.skipIf(sys.version_info < (3, 11), "re supports atomic groups since Python 3.11")
+    def test_atomic(self):
+        self.assertEqual(atomic("a+b"), "(?>a+b)")
+
+    @unittest.skipIf(sys.version_info < (3, 11), "re supports atomic groups since Python 3.11")
+    def test_single_char_needs_no_atomic_group(self):
+        self.assertEqual(atomic("a"), "a")
+
+    @unittest.skipIf(sys.version_info < (3, 11), "re supports atomic groups since Python 3.11")
+    def test_atomic_quantifiers(self):
+        self.assertEqual(one_or_more("ab", atomic=True), "(?>(?:ab)+)")
+        self.assertEqual(zero_or_more("[a-z]", atomic=True), "(?>[a-z]*)")
+        self.assertEqual(at_least_n_but_not_more_than_m_times(2, 5, "ab", atomic=True), "(?>(?:ab){2,5})")
+
+    @unittest.skipIf(sys.version_info < (3, 11), "re supports atomic groups since Python 3.11")
+    def test_exactly_n_times(self):
+        self.assertEqual(exactly_n_times(3, "ab", atomic=True), "(?>(?:ab){3})")
+
+    @unittest.skipIf(sys.version_info < (3, 11), "re supports atomic groups since Python 3.11")
+    def test_at_most_n_times(self):
+        self.assertEqual(at_most_n_times(3, "ab", greedy=False, atomic=True), "(?>(?:ab){,3}?)")
+
+    def test_unsupported_runtime_raises(self):
+        rebuild.builder.ATOMIC_GROUPS_SUPPORTED = False
+
+        with self.assertRaises(ValueError):
+            atomic("a+")
+        with self.assertRaises(ValueError):
+            one_or_more("ab", atomic=True)
+        with self.assertRaises(ValueError):
+            exactly_n_times(2, "ab", atomic=True)
+
+
+if __name__ == "__main__":
+    unittest.main()